@@ -6,41 +6,124 @@
 import streamlit as st
 import os
 import json
+import hashlib
 import itertools
-from openai import OpenAI
+import asyncio
+import threading
+import time
+import functools
+import concurrent.futures
+import httpx
+import numpy as np
+import openai
+from openai import OpenAI, AsyncOpenAI
+from pydantic import BaseModel
+from dotenv import dotenv_values
+from streamlit.runtime.caching.storage.local_disk_cache_storage import get_cache_folder_path
 
 
 
 # Helper function to set OpenAI API key from secrets or .env
 def set_api_key_env():
-    api_key = None
+    # Fast path: once the key is found it is kept in the environment, so later reruns stop here
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if api_key:
+        return api_key
     # Try to get from Streamlit secrets, but handle missing secrets.toml gracefully
     try:
         if hasattr(st, 'secrets') and 'openai_api_key' in st.secrets:
             api_key = st.secrets['openai_api_key']
     except Exception:
         pass
-    # Try to get from environment
-    if not api_key:
-        api_key = os.environ.get('OPENAI_API_KEY')
     # Try to load from .env if not found
-    if not api_key and os.path.exists('.env'):
-        with open('.env') as f:
-            for line in f:
-                if line.startswith('OPENAI_API_KEY='):
-                    api_key = line.strip().split('=', 1)[1]
-                    break
+    if not api_key:
+        api_key = dotenv_values('.env').get('OPENAI_API_KEY')
     if api_key:
         os.environ['OPENAI_API_KEY'] = api_key
     return api_key
 
+# Connection pool settings shared by both OpenAI clients, so every call reuses open TCP/TLS connections
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
 # Function to initialize OpenAI client
 @st.cache_resource(show_spinner=False)
 def get_openai_client():
-    return OpenAI()
+    return OpenAI(http_client=httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT))
+
+# Function to initialize the async OpenAI client used to run web searches concurrently.
+# SDK retries are off: call_with_retry retries every async call itself, so the rate limiter sees each attempt.
+@st.cache_resource(show_spinner=False)
+def get_async_openai_client():
+    return AsyncOpenAI(http_client=httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT), max_retries=0)
+
+# Function to start a single background event loop for all async OpenAI calls.
+# asyncio.run() would open and close a new loop on every rerun, which breaks the
+# cached async client because its connections belong to the loop that opened them.
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Calls faster than this are counted as cache hits, since st.cache_data returns stored results almost instantly
+CACHE_HIT_MS = 1.0
+
+# Function to record one LLM call (latency and whether it was a cache hit) in session state.
+# Called from the script thread, so calls that run on the background event loop are timed by their caller.
+def record_llm_call(fn_name, ms, cached):
+    stats = st.session_state.setdefault('cache_stats', [])
+    stats.append({"fn": fn_name, "ms": round(ms, 1), "cached": cached})
+    # Keep only the most recent calls
+    del stats[:-100]
+
+# Decorator that records each call of a cached LLM helper. Put it above @st.cache_data so cache hits are timed too.
+def track_llm_call(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        ms = (time.perf_counter() - t0) * 1000
+        record_llm_call(fn.__name__, ms, ms < CACHE_HIT_MS)
+        return result
+    return wrapper
 
-# Function to ask clarifying questions using the LLM
-@st.cache_data(show_spinner=False)
+# Function to show the recorded LLM call stats in a sidebar placeholder
+def show_cache_stats(stats_area):
+    if st.session_state.get('cache_stats'):
+        with stats_area.container():
+            st.header('LLM Call Stats')
+            st.dataframe(st.session_state['cache_stats'], hide_index=True)
+
+# How long disk-persisted results are reused. Streamlit ignores ttl when persist="disk" is set,
+# so the helpers below take a hashed day argument instead and old files are pruned by hand.
+DISK_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Function to get the current cache day; persisted entries stored under an earlier day are never read again
+def cache_day():
+    return int(time.time() // DISK_CACHE_TTL_SECONDS)
+
+# Function to delete cache files older than the disk TTL, since Streamlit never removes them itself.
+# Runs at most once an hour per process; a file that old always belongs to an expired cache day.
+@st.cache_resource(show_spinner=False, ttl="1h")
+def prune_disk_cache():
+    cache_dir = get_cache_folder_path()
+    if not os.path.isdir(cache_dir):
+        return
+    cutoff = time.time() - DISK_CACHE_TTL_SECONDS
+    for entry in os.scandir(cache_dir):
+        try:
+            if entry.name.endswith(".memo") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            # Another process may have removed it already
+            pass
+
+# Function to ask clarifying questions using the LLM.
+# Helpers that return a response id are cached in memory only: a response id read back from disk can
+# outlive the stored response or belong to another API key, and previous_response_id would then fail.
+@track_llm_call
+@st.cache_data(show_spinner=False, ttl="1h", max_entries=128)
 def get_clarifying_questions(_client, topic, developer_message, model_mini):
     prompt_to_clarify = f"""
 Ask 5 numbered clarifying question to the user about the topic: {topic}.
@@ -58,32 +141,73 @@ Reply only with the questions.
     questions = clarify.output[0].content[0].text.split("\n")
     return questions, clarify.id
 
+# Structured output of the planning call: a goal sentence and the web search queries to reach it
+class Plan(BaseModel):
+    goal: str
+    queries: list[str]
+
+# Structured output of the evaluator: whether the collected data satisfies the research goal
+class Verdict(BaseModel):
+    enough: bool
+
+# Structured output of the call that asks for more web search queries
+class MoreQueries(BaseModel):
+    queries: list[str]
+
 # Function to get research goal and queries
-@st.cache_data(show_spinner=False)
+@track_llm_call
+@st.cache_data(show_spinner=False, ttl="1h", max_entries=128)
 def get_goal_and_queries(_client, answers, questions, topic, developer_message, model, clarify_id):
     prompt_goals = f"""
 Using the user answers {answers} to questions {questions}, write a goal sentence and 5 web search queries for the research about {topic}
 Output: A json list of 5 web search queries and a goal sentence that wil reach it
 Format: {{\"goal\":\"...\", \"queries\":[\"q1\",.....]}}
 """
-    goal_and_queries = _client.responses.create(
+    # Structured output guarantees valid JSON, so there is no json.loads that can fail
+    goal_and_queries = _client.responses.parse(
         model=model,
         input=prompt_goals,
         previous_response_id=clarify_id,
-        instructions=developer_message
+        instructions=developer_message,
+        text_format=Plan
     )
-    plan = json.loads(goal_and_queries.output[0].content[0].text)
+    plan = goal_and_queries.output_parsed.model_dump()
     return plan, goal_and_queries.id
 
-# Function to run a web search query
-@st.cache_data(show_spinner=False)
-def run_search(_client, q, developer_message, model, tools):
-    web_search = _client.responses.create(
+# Function to build a short, stable cache key for JSON-like data such as the collected search results.
+# Cached helpers are keyed on this instead of the data; get_evaluation also takes the data itself as an
+# underscore argument (not hashed by Streamlit), while cached_report only needs the key.
+def content_key(data):
+    return hashlib.blake2b(json.dumps(data, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+# Structured output of the fused planning call: questions, assumed answers, goal and queries in one shot
+class SingleShotPlan(BaseModel):
+    questions: list[str]
+    answers: list[str]
+    goal: str
+    queries: list[str]
+
+# Function to get clarifying questions, default answers, goal and queries in a single LLM call
+@track_llm_call
+@st.cache_data(show_spinner=False, ttl="1h", max_entries=128)
+def get_plan_single_shot(_client, topic, developer_message, model):
+    prompt_plan = f"""
+First, ask 5 clarifying questions about the topic: {topic}, to understand the intended purpose of the research.
+Then answer each question yourself with a sensible default assumption.
+Using those answers, write a goal sentence and 5 web search queries for the research about {topic}.
+"""
+    single_shot = _client.responses.parse(
         model=model,
-        input=f"seach: {q}",
+        input=prompt_plan,
         instructions=developer_message,
-        tools=tools
+        text_format=SingleShotPlan
     )
+    result = single_shot.output_parsed
+    plan = {"goal": result.goal, "queries": result.queries}
+    return result.questions, result.answers, plan, single_shot.id
+
+# Function to turn a web search response into the collected data format
+def parse_search_output(q, web_search):
     # Defensive: check output length and handle errors
     if len(web_search.output) > 1 and hasattr(web_search.output[1], 'id') and hasattr(web_search.output[1], 'content'):
         return {
@@ -99,48 +223,375 @@ def run_search(_client, q, developer_message, model, tools):
             "research_output": f"Error: Unexpected response format: {web_search.output}"
         }
 
-# Function to evaluate if the research goal is met
-@st.cache_data(show_spinner=False)
-def evaluate(_client, collected, goal, developer_message, model):
-    review = _client.responses.create(
-        model=model,
+# Token bucket that keeps requests under the requests-per-minute limit. It starts full, so a burst
+# within the budget goes out at once, and refills at the per-minute rate after that.
+class RequestRateLimiter:
+    def __init__(self, max_requests_per_minute):
+        self.capacity = max_requests_per_minute
+        self.tokens = float(max_requests_per_minute)
+        self.refill_per_second = max_requests_per_minute / 60.0
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+
+    async def wait(self):
+        # All requests share the same event loop, so taking a token needs no lock
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_second)
+            self.last_refill = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(max(self.paused_until - now, (1 - self.tokens) / self.refill_per_second))
+
+    def pause(self, seconds):
+        # Hold back every request sharing this limiter, not just the one that was rate limited
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# Function to get the rate limiter for a requests-per-minute budget. The limit applies to the API key,
+# so every search, summary and evaluation of every session shares one bucket.
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter(max_requests_per_minute):
+    return RequestRateLimiter(max_requests_per_minute)
+
+# Errors worth retrying: the same ones the SDK's built-in retries cover
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+# Function to get how long to wait before retrying, using the server's Retry-After header when it sends one
+def retry_delay(error, attempt):
+    headers = error.response.headers if isinstance(error, openai.APIStatusError) else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After can also be an HTTP date; fall back to exponential backoff
+        pass
+    return 2 ** attempt
+
+# Function to retry an OpenAI request with backoff when rate limited, timed out or on a server error
+async def call_with_retry(make_request, limiter, max_attempts=3):
+    for attempt in range(max_attempts):
+        await limiter.wait()
+        try:
+            return await make_request()
+        except RETRYABLE_ERRORS as error:
+            if attempt == max_attempts - 1:
+                raise
+            limiter.pause(retry_delay(error, attempt))
+
+# Function to condense one search result into short bullet points for the cheaper pipeline steps
+async def summarize_search_async(aclient, text, model_mini):
+    summary = await aclient.responses.create(
+        model=model_mini,
+        input=f"Summarize the key facts of this web search result in at most 300 tokens of bullet points:\n\n{text}",
+        max_output_tokens=400
+    )
+    return summary.output[0].content[0].text
+
+# Length of the plain-text fallback used when a search result can't be summarized
+SUMMARY_FALLBACK_CHARS = 1200
+
+# Function to add a summary to a search result; error results keep their error text as the summary.
+# The summary is optional, so if it still fails after retries the start of the full text is used instead.
+async def add_summary_async(aclient, result, model_mini, limiter):
+    if result["resp_id"]:
+        try:
+            result["summary"] = await call_with_retry(
+                lambda: summarize_search_async(aclient, result["research_output"], model_mini), limiter
+            )
+        except Exception:
+            result["summary"] = result["research_output"][:SUMMARY_FALLBACK_CHARS]
+    else:
+        result["summary"] = result["research_output"]
+    return result
+
+# Function to run a web search query without blocking the other searches, then summarize it
+async def run_search_async(aclient, q, developer_message, model, tools, model_mini, semaphore, limiter):
+    # The semaphore caps how many requests are in flight at once
+    async with semaphore:
+        web_search = await call_with_retry(
+            lambda: aclient.responses.create(
+                model=model,
+                input=f"seach: {q}",
+                instructions=developer_message,
+                tools=tools
+            ),
+            limiter
+        )
+        result = parse_search_output(q, web_search)
+        return await add_summary_async(aclient, result, model_mini, limiter)
+
+# Function to run all web searches at the same time and update the progress bar as each one finishes
+def run_searches(aclient, queries, developer_message, model, tools, model_mini, progress, max_concurrent, limiter):
+    loop = get_event_loop()
+    semaphore = asyncio.Semaphore(max_concurrent)
+    futures = [
+        asyncio.run_coroutine_threadsafe(
+            run_search_async(aclient, q, developer_message, model, tools, model_mini, semaphore, limiter), loop
+        )
+        for q in queries
+    ]
+    for done, _ in enumerate(concurrent.futures.as_completed(futures), start=1):
+        progress.progress(done / len(futures), text=f'Completed {done} of {len(futures)} searches')
+    # Keep the results in the same order as the queries
+    return [future.result() for future in futures]
+
+# Raised by the cached lookups below on a miss. st.cache_data doesn't store exceptions,
+# so a miss is never cached and the lookup can tell a stored value from a missing one.
+class CacheMiss(Exception):
+    pass
+
+# Function to look up a search result in the disk-backed cache, or store one when _result is given
+@st.cache_data(show_spinner=False, persist="disk", max_entries=512)
+def cached_search(q, developer_message, model, tools, model_mini, day, _result=None):
+    if _result is None:
+        raise CacheMiss(q)
+    return _result
+
+# Function to run all web searches through the OpenAI Batch API (half the cost, but can take up to 24h)
+def run_searches_batch(client, queries, developer_message, model, tools, progress, poll_interval=5):
+    # One /v1/responses request per query, sent as a JSONL file
+    batch_lines = [
+        json.dumps({
+            "custom_id": f"query-{idx}",
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": {"model": model, "input": f"seach: {q}", "instructions": developer_message, "tools": tools}
+        })
+        for idx, q in enumerate(queries)
+    ]
+    batch_input = client.files.create(file=("batch_in.jsonl", "\n".join(batch_lines).encode()), purpose="batch")
+    batch = client.batches.create(input_file_id=batch_input.id, endpoint="/v1/responses", completion_window="24h")
+    # Poll until the batch is done, showing how many searches have finished
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        if counts and counts.total:
+            done = counts.completed + counts.failed
+            progress.progress(done / counts.total, text=f'Completed {done} of {counts.total} searches (batch {batch.status})')
+    # Successful requests are in the output file and failed ones in the error file; both are keyed by custom_id
+    outputs = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            for line in client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    result = json.loads(line)
+                    outputs[result["custom_id"]] = result
+    return [parse_batch_output(q, outputs.get(f"query-{idx}"), batch.status) for idx, q in enumerate(queries)]
+
+# Function to summarize all batch results once the batch is done, within the same concurrency and rate limits
+async def add_summaries_async(aclient, results, model_mini, max_concurrent, limiter):
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def bounded(result):
+        async with semaphore:
+            return await add_summary_async(aclient, result, model_mini, limiter)
+
+    return await asyncio.gather(*(bounded(result) for result in results))
+
+# Function to turn one line of the batch output file into the collected data format
+def parse_batch_output(q, result, batch_status):
+    output = ((result or {}).get("response") or {}).get("body", {}).get("output", [])
+    # Defensive: same shape check as parse_search_output, on the raw JSON instead of SDK objects
+    if len(output) > 1 and output[1].get("id") and output[1].get("content"):
+        return {
+            "query": q,
+            "resp_id": output[1]["id"],
+            "research_output": output[1]["content"][0]["text"]
+        }
+    else:
+        # Return error info for debugging
+        # A failed request has either a top-level error or an error body with a non-200 status code
+        error = ((result or {}).get("error") or ((result or {}).get("response") or {}).get("body", {}).get("error")
+                 or f"batch {batch_status}")
+        return {
+            "query": q,
+            "resp_id": None,
+            "research_output": f"Error: Unexpected batch response: {error}"
+        }
+
+# Function to embed several texts in one API call, normalized so a dot product is the cosine similarity
+@track_llm_call
+@st.cache_data(show_spinner=False, persist="disk", max_entries=128)
+def embed_texts(_client, texts, model, day):
+    response = _client.embeddings.create(model=model, input=list(texts))
+    embeddings = np.array([item.embedding for item in response.data])
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+# Function to build the session search cache key for an embedding
+def embedding_key(embedding):
+    return hashlib.blake2b(np.round(embedding, 3).tobytes(), digest_size=16).hexdigest()
+
+# Function to find the index of the most similar embedding above the threshold, or None
+def find_similar(embedding, embeddings, threshold):
+    if not embeddings:
+        return None
+    similarities = np.array(embeddings) @ embedding
+    best = int(np.argmax(similarities))
+    return best if similarities[best] > threshold else None
+
+# Function to reuse the clarifying questions of a similar topic asked earlier in this session.
+# st.session_state["q_cache"] holds (embedding, questions, clarify_id) for every topic asked so far.
+def get_clarifying_questions_semantic(client, topic, developer_message, model_mini, embedding_model, threshold):
+    embedding = embed_texts(client, [topic], embedding_model, cache_day())[0]
+    q_cache = st.session_state.setdefault('q_cache', [])
+    match = find_similar(embedding, [entry[0] for entry in q_cache], threshold)
+    if match is not None:
+        _, questions, clarify_id = q_cache[match]
+        return questions, clarify_id
+    questions, clarify_id = get_clarifying_questions(client, topic, developer_message, model_mini)
+    q_cache.append((embedding, questions, clarify_id))
+    return questions, clarify_id
+
+# Function to run only the web searches that are not already covered by earlier results.
+# Exact duplicates (ignoring case and spaces) are dropped, queries that are semantically close
+# to one another are searched once, and queries close to an earlier search reuse its result.
+# search_cache maps a rounded-embedding hash to {"embedding", "result"} and lives in session state;
+# cached_search keeps exact-query results on disk, so for up to a day they also survive new sessions and restarts.
+def search_new_queries(client, aclient, queries, collected, search_cache, developer_message, model, tools, model_mini,
+                       embedding_model, threshold, progress, use_batch_api, max_concurrent, max_requests_per_minute):
+    unique = list({q.strip().lower(): q.strip() for q in queries}.values())
+    if not unique:
+        return []
+    cached = list(search_cache.values())
+    cached_embeddings = [entry["embedding"] for entry in cached]
+    to_search, to_search_embeddings, reused = [], [], []
+    for q, embedding in zip(unique, embed_texts(client, unique, embedding_model, cache_day())):
+        match = find_similar(embedding, cached_embeddings, threshold)
+        if match is not None:
+            # Already searched: reuse the result if it isn't part of this research yet
+            if cached[match]["result"] not in collected and cached[match]["result"] not in reused:
+                reused.append(cached[match]["result"])
+            st.write(f"Reusing earlier results for query: {q}")
+        elif find_similar(embedding, to_search_embeddings, threshold) is None:
+            try:
+                # Same query searched before, possibly before an app restart
+                t0 = time.perf_counter()
+                reused.append(cached_search(q, developer_message, model, tools, model_mini, cache_day()))
+                record_llm_call("cached_search", (time.perf_counter() - t0) * 1000, True)
+                search_cache[embedding_key(embedding)] = {"embedding": embedding, "result": reused[-1]}
+                st.write(f"Reusing cached results for query: {q}")
+            except CacheMiss:
+                to_search.append(q)
+                to_search_embeddings.append(embedding)
+                st.write(f"Collecting data for query: {q}")
+    if not to_search:
+        return reused
+    limiter = get_rate_limiter(max_requests_per_minute)
+    t0 = time.perf_counter()
+    if use_batch_api:
+        results = run_searches_batch(client, to_search, developer_message, model, tools, progress)
+        results = asyncio.run_coroutine_threadsafe(add_summaries_async(aclient, results, model_mini, max_concurrent, limiter),
+                                                   get_event_loop()).result()
+        fn_name = "run_searches_batch"
+    else:
+        results = run_searches(aclient, to_search, developer_message, model, tools, model_mini, progress, max_concurrent, limiter)
+        fn_name = "run_searches"
+    # One row for the whole fan-out: a search plus a summary per query
+    record_llm_call(f"{fn_name} ({len(to_search)} queries)", (time.perf_counter() - t0) * 1000, False)
+    for q, embedding, result in zip(to_search, to_search_embeddings, results):
+        # Failed searches are not remembered, so they are tried again next time
+        if result["resp_id"]:
+            search_cache[embedding_key(embedding)] = {"embedding": embedding, "result": result}
+            cached_search(q, developer_message, model, tools, model_mini, cache_day(), _result=result)
+    return reused + results
+
+# Function to keep only the query and its summary, so evaluating and planning don't resend the full search text
+def collected_summaries(collected):
+    return [{"query": c["query"], "summary": c["summary"]} for c in collected]
+
+# Function to evaluate if the research goal is met; a yes/no verdict, so the mini model is enough
+async def evaluate_async(aclient, collected, goal, developer_message, model_mini):
+    review = await aclient.responses.parse(
+        model=model_mini,
         input=[
             {"role": "developer", "content": f"Reasearch goal: {goal}"},
-            {"role": "assistant", "content": json.dumps(collected)},
-            {"role": "user", "content": "Does this information will fully satisfy the goal? Answer Yes or No only!"}
+            {"role": "assistant", "content": json.dumps(collected_summaries(collected))},
+            {"role": "user", "content": "Does this information will fully satisfy the goal?"}
         ],
-        instructions=developer_message
+        instructions=developer_message,
+        text_format=Verdict,
+        # The verdict is a few tokens; 16 is the smallest limit the Responses API accepts
+        max_output_tokens=16
     )
-    return "yes" in review.output[0].content[0].text.lower()
+    return review.output_parsed.enough
 
 # Function to get more queries if needed
-@st.cache_data(show_spinner=False)
-def get_more_queries(_client, collected, goal, developer_message, model, goal_and_queries_id):
-    more_searches = _client.responses.create(
+async def get_more_queries_async(aclient, collected, goal, developer_message, model, goal_and_queries_id):
+    more_searches = await aclient.responses.parse(
         model=model,
         input=[
-            {"role": "assistant", "content": f"Current data: {json.dumps(collected)}"},
+            {"role": "assistant", "content": f"Current data: {json.dumps(collected_summaries(collected))}"},
             {"role": "developer", "content": f"Reasearch goal: {goal}. write 5 other web searchs to achieve the goal"},
         ],
         instructions=developer_message,
-        previous_response_id=goal_and_queries_id
+        previous_response_id=goal_and_queries_id,
+        text_format=MoreQueries
     )
-    return json.loads(more_searches.output[0].content[0].text)
+    return more_searches.output_parsed.queries
+
+# Function to evaluate the collected data while speculatively asking for more queries at the same time.
+# If the goal is met the extra queries are cancelled; if not, they are ready without a second round-trip.
+async def evaluate_with_more_queries(aclient, collected, goal, developer_message, model, model_mini, goal_and_queries_id, limiter):
+    eval_task = asyncio.create_task(call_with_retry(
+        lambda: evaluate_async(aclient, collected, goal, developer_message, model_mini), limiter
+    ))
+    more_task = asyncio.create_task(call_with_retry(
+        lambda: get_more_queries_async(aclient, collected, goal, developer_message, model, goal_and_queries_id), limiter
+    ))
+    try:
+        enough = await eval_task
+    except BaseException:
+        more_task.cancel()
+        raise
+    if enough:
+        more_task.cancel()
+        # Wait for the cancel to land; if the call had already failed, this retrieves the error instead of leaving it to be logged
+        await asyncio.gather(more_task, return_exceptions=True)
+        return True, []
+    return False, await more_task
 
-# Function to write the final report
-@st.cache_data(show_spinner=False)
-def write_report(_client, collected, goal, developer_message, model):
-    report = _client.responses.create(
+# Function to get the (enough, more queries) outcome for the collected data, cached by its content key.
+# The coroutine runs on the shared event loop; the client, data, response id and limiter are not hashed.
+@track_llm_call
+@st.cache_data(show_spinner=False, persist="disk", max_entries=128)
+def get_evaluation(collected_key, goal, developer_message, model, model_mini, day, _aclient, _collected, _goal_and_queries_id, _limiter):
+    return asyncio.run_coroutine_threadsafe(
+        evaluate_with_more_queries(_aclient, _collected, goal, developer_message, model, model_mini, _goal_and_queries_id, _limiter),
+        get_event_loop()
+    ).result()
+
+# Function to build the model input for the final report
+def report_input(collected, goal):
+    return [
+        {"role": "developer", "content": (f"Write a complete and detailed report about reasearch goal: {goal} "
+        "Cite sources inline using  [n] and append a reference "
+        "list mapping [n] to url")},
+        # The report is written from the full search text, not the summaries
+        {"role": "assistant", "content": json.dumps([{k: v for k, v in c.items() if k != "summary"} for c in collected])},
+    ]
+
+# Function to stream the final report token by token, so the user sees it while it is being written
+def stream_report(client, collected, goal, developer_message, model):
+    with client.responses.stream(
         model=model,
-        input=[
-            {"role": "developer", "content": (f"Write a complete and detailed report about reasearch goal: {goal} "
-            "Cite sources inline using  [n] and append a reference "
-            "list mapping [n] to url")},
-            {"role": "assistant", "content": json.dumps(collected)},
-        ],
+        input=report_input(collected, goal),
         instructions=developer_message
-    )
-    return report.output[0].content[0].text
+    ) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+
+# Function to look up a finished report in the disk-backed cache, or store one when _report is given.
+# The report is always written by stream_report; this only replays it for the same goal and data.
+@st.cache_data(show_spinner=False, persist="disk", max_entries=32)
+def cached_report(collected_key, goal, developer_message, model, day, _report=None):
+    if _report is None:
+        raise CacheMiss(collected_key)
+    return _report
 
 # Streamlit UI
 st.title('Deep Research Streamlit App')
@@ -155,15 +606,113 @@ if not api_key:
     st.stop()
 
 client = get_openai_client()
+aclient = get_async_openai_client()
+prune_disk_cache()
 
 MODEL = "gpt-4.1"
 MODEL_MINI = "gpt-4.1-mini"
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Queries with a cosine similarity above this are treated as the same search
+SEARCH_SIMILARITY_THRESHOLD = 0.92
+# Topics with a cosine similarity above this share the same clarifying questions
+TOPIC_SIMILARITY_THRESHOLD = 0.93
 TOOLS = [{"type": "web_search"}]
 developer_message = """
 You are an expert Deep Researcher.
 You provide complete and in depth research to the user.
 """
 
+# Print-specific CSS to expand all textareas and inputs for printing and remove scroll for print
+_PRINT_CSS = """
+<style>
+@media print {
+    html, body, .main, .block-container, .stApp {
+        height: auto !important;
+        overflow: visible !important;
+    }
+    .stApp {
+        max-height: none !important;
+    }
+    .block-container {
+        padding-top: 0 !important;
+    }
+    textarea, input[type="text"] {
+        height: auto !important;
+        min-height: 40px !important;
+        max-height: none !important;
+        overflow: visible !important;
+        white-space: pre-wrap !important;
+    }
+    .stTextInput>div>div>input {
+        width: 100% !important;
+        min-width: 300px !important;
+    }
+}
+</style>
+"""
+
+# Sidebar controls to keep concurrent web searches within the OpenAI rate limits
+st.sidebar.header('Search Settings')
+max_concurrent = st.sidebar.number_input('Max concurrent searches', min_value=2, max_value=10, value=5)
+max_requests_per_minute = st.sidebar.number_input('Max requests per minute', min_value=1, max_value=10000, value=60)
+use_batch_api = st.sidebar.checkbox('Use Batch API (50% cheaper, results can take up to 24h)', value=False)
+skip_clarification = st.sidebar.checkbox('Skip clarifying questions (plan in one call)', value=False)
+# Placeholder for the LLM call stats, filled at the end of the script and again by the research fragment
+stats_area = st.sidebar.empty()
+
+# The research run is a fragment: pressing "Run Research" reruns only this block,
+# not the topic form, clarifying questions and planning above it.
+@st.fragment
+def run_research_fragment(client, aclient, plan, goal_and_queries_id, questions, answers, developer_message, model, model_mini, tools,
+                          use_batch_api, max_concurrent, max_requests_per_minute, stats_area):
+    goal = plan["goal"]
+    queries = plan["queries"]
+    # Step 4: Run web searches and collect data
+    if not st.button('Run Research'):
+        return
+    collected = []
+    search_cache = st.session_state.setdefault('search_cache', {})
+    progress = st.progress(0, text='Running web searches...')
+    collected.extend(search_new_queries(client, aclient, queries, collected, search_cache, developer_message, model, tools, model_mini,
+                                        EMBEDDING_MODEL, SEARCH_SIMILARITY_THRESHOLD, progress, use_batch_api, max_concurrent, max_requests_per_minute))
+    progress.empty()
+    # Step 5: Evaluate if enough information is collected (more queries are generated in parallel)
+    with st.spinner('Evaluating if enough information is collected...'):
+        # Same goal and data as an earlier run: the cached verdict and extra queries come back without a call
+        enough, queries = get_evaluation(content_key(collected), goal, developer_message, model, model_mini, cache_day(),
+                                         aclient, collected, goal_and_queries_id, get_rate_limiter(max_requests_per_minute))
+    if not enough:
+        st.warning('Not enough information. Running more queries...')
+        progress = st.progress(0, text='Running more web searches...')
+        collected.extend(search_new_queries(client, aclient, queries, collected, search_cache, developer_message, model, tools, model_mini,
+                                            EMBEDDING_MODEL, SEARCH_SIMILARITY_THRESHOLD, progress, use_batch_api, max_concurrent, max_requests_per_minute))
+        progress.empty()
+    # Hash the final collected data once; the cached report helper uses this key instead of re-hashing it
+    collected_key = content_key(collected)
+    # Show Q&A summary as plain text for printing/analysis
+    st.markdown('### Clarifying Questions and Answers')
+    # One markdown element for all pairs instead of one element per pair
+    summary_md = "\n\n".join(f"**Q{i+1}: {q}**  \n**A{i+1}:** {a}" for i, (q, a) in enumerate(zip(questions, answers)))
+    st.markdown(summary_md)
+    # Step 6: Write and display the final report
+    st.markdown('### Final Research Report')
+    t0 = time.perf_counter()
+    try:
+        # Same goal and data as an earlier run, possibly before an app restart: replay the cached report
+        report = cached_report(collected_key, goal, developer_message, model, cache_day())
+        record_llm_call("cached_report", (time.perf_counter() - t0) * 1000, True)
+        st.markdown(report, unsafe_allow_html=True)
+    except CacheMiss:
+        report = st.write_stream(stream_report(client, collected, goal, developer_message, model))
+        record_llm_call("stream_report", (time.perf_counter() - t0) * 1000, False)
+        cached_report(collected_key, goal, developer_message, model, cache_day(), _report=report)
+    # Add print-specific CSS so the report prints in full
+    st.markdown(_PRINT_CSS, unsafe_allow_html=True)
+    # Show print instructions instead of a print button
+    st.info('To print or save the report, use your browser\'s print feature: press Ctrl+P (Windows) or Cmd+P (Mac).')
+    # A fragment rerun doesn't reach the end of the script, so redraw the stats for this run here
+    show_cache_stats(stats_area)
+
 # Step 1: Get research topic from user
 with st.form('topic_form'):
     topic = st.text_input('Enter the research topic:')
@@ -176,81 +725,34 @@ if submitted and topic:
 
 if st.session_state['topic']:
     st.success(f"Research Topic: {st.session_state['topic']}")
-    # Step 2: Get clarifying questions
-    with st.spinner('Generating clarifying questions...'):
-        questions, clarify_id = get_clarifying_questions(client, st.session_state['topic'], developer_message, MODEL_MINI)
-    st.write('Please answer the following clarifying questions:')
-    answers = []
-    for i, q in enumerate(questions):
-        ans = st.text_input(f"Q{i+1}: {q}", key=f"answer_{i}")
-        answers.append(ans)
-    if all(answers):
+    if skip_clarification:
+        # Steps 2 and 3 in one call: the model answers its own clarifying questions with default assumptions
+        with st.spinner('Generating research goal and queries...'):
+            questions, answers, plan, goal_and_queries_id = get_plan_single_shot(client, st.session_state['topic'], developer_message, MODEL)
+    else:
+        # Step 2: Get clarifying questions
+        with st.spinner('Generating clarifying questions...'):
+            questions, clarify_id = get_clarifying_questions_semantic(client, st.session_state['topic'], developer_message, MODEL_MINI,
+                                                                     EMBEDDING_MODEL, TOPIC_SIMILARITY_THRESHOLD)
+        st.write('Please answer the following clarifying questions:')
+        answers = []
+        for i, q in enumerate(questions):
+            ans = st.text_input(f"Q{i+1}: {q}", key=f"answer_{i}")
+            answers.append(ans)
+        # Wait until every question is answered
+        if not all(answers):
+            show_cache_stats(stats_area)
+            st.stop()
         # Step 3: Get goal and queries
         with st.spinner('Generating research goal and queries...'):
             plan, goal_and_queries_id = get_goal_and_queries(client, answers, questions, st.session_state['topic'], developer_message, MODEL, clarify_id)
-        goal = plan["goal"]
-        queries = plan["queries"]
-        st.info(f"Research Goal: {goal}")
-        st.write('Web Search Queries:')
-        for q in queries:
-            st.write(f"- {q}")
-        # Step 4: Run web searches and collect data
-        if st.button('Run Research'):
-            collected = []
-            progress = st.progress(0, text='Running web searches...')
-            for idx, q in enumerate(queries):
-                st.write(f"Collecting data for query: {q}")
-                with st.spinner(f'Running web search for: {q}'):
-                    collected.append(run_search(client, q, developer_message, MODEL, TOOLS))
-                progress.progress((idx + 1) / len(queries), text=f'Completed {idx + 1} of {len(queries)} searches')
-            progress.empty()
-            # Step 5: Evaluate if enough information is collected
-            with st.spinner('Evaluating if enough information is collected...'):
-                enough = evaluate(client, collected, goal, developer_message, MODEL)
-            if not enough:
-                st.warning('Not enough information. Generating more queries...')
-                with st.spinner('Generating more queries...'):
-                    queries = get_more_queries(client, collected, goal, developer_message, MODEL, goal_and_queries_id)
-                for idx, q in enumerate(queries):
-                    st.write(f"Collecting data for query: {q}")
-                    with st.spinner(f'Running web search for: {q}'):
-                        collected.append(run_search(client, q, developer_message, MODEL, TOOLS))
-            # Step 6: Write and display the final report
-            with st.spinner('Writing final research report...'):
-                report = write_report(client, collected, goal, developer_message, MODEL)
-            # Show Q&A summary as plain text for printing/analysis
-            st.markdown('### Clarifying Questions and Answers')
-            for i, (q, a) in enumerate(zip(questions, answers)):
-                st.markdown(f"**Q{i+1}: {q}**  <br>**A{i+1}:** {a}", unsafe_allow_html=True)
-            st.markdown('### Final Research Report')
-            st.markdown(report, unsafe_allow_html=True)
-            # Add print-specific CSS to expand all textareas and inputs for printing and remove scroll for print
-            st.markdown("""
-                <style>
-                @media print {
-                    html, body, .main, .block-container, .stApp {
-                        height: auto !important;
-                        overflow: visible !important;
-                    }
-                    .stApp {
-                        max-height: none !important;
-                    }
-                    .block-container {
-                        padding-top: 0 !important;
-                    }
-                    textarea, input[type="text"] {
-                        height: auto !important;
-                        min-height: 40px !important;
-                        max-height: none !important;
-                        overflow: visible !important;
-                        white-space: pre-wrap !important;
-                    }
-                    .stTextInput>div>div>input {
-                        width: 100% !important;
-                        min-width: 300px !important;
-                    }
-                }
-                </style>
-            """, unsafe_allow_html=True)
-            # Show print instructions instead of a print button
-            st.info('To print or save the report, use your browser\'s print feature: press Ctrl+P (Windows) or Cmd+P (Mac).')
+    goal = plan["goal"]
+    queries = plan["queries"]
+    st.info(f"Research Goal: {goal}")
+    st.write('Web Search Queries:')
+    for q in queries:
+        st.write(f"- {q}")
+    run_research_fragment(client, aclient, plan, goal_and_queries_id, questions, answers, developer_message, MODEL, MODEL_MINI, TOOLS,
+                          use_batch_api, max_concurrent, max_requests_per_minute, stats_area)
+
+show_cache_stats(stats_area)